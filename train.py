@@ -1,10 +1,15 @@
+import os
+import multiprocessing
+import warnings
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, DataLoader
 from transformers import AutoTokenizer, AutoModel, MT5ForConditionalGeneration
+from transformers.trainer_pt_utils import LengthGroupedSampler
 from datasets import load_dataset
+from datasets.fingerprint import Hasher
+from safetensors.torch import save_file
 import wandb
 
-
 # Đăng nhập vào wandb
 wandb.login(key='7ac28caf9e3dc3e0685c97df182d52e13a81e311')
 
@@ -37,21 +42,88 @@ class EmbedFusion(torch.nn.Module):
 simcse_model_name = "wanhin/msimcse_vi-en"
 mt5_model_name = "google/mt5-base"
 
+# Prefer PyTorch's fused scaled-dot-product attention, falling back to eager attention for
+# model classes that don't support it
+def load_model(model_cls, model_name):
+    try:
+        return model_cls.from_pretrained(model_name, attn_implementation="sdpa")
+    except (ValueError, TypeError) as e:
+        # ValueError: the model class has no SDPA support; TypeError: transformers predates attn_implementation
+        sdpa_unsupported = isinstance(e, ValueError) and "does not support an attention implementation" in str(e)
+        kwarg_unknown = isinstance(e, TypeError) and "attn_implementation" in str(e)
+        if not (sdpa_unsupported or kwarg_unknown):
+            raise
+        warnings.warn(f"Loading {model_name} with eager attention because SDPA is unavailable: {e}")
+        return model_cls.from_pretrained(model_name)
+
 simcse_tokenizer = AutoTokenizer.from_pretrained(simcse_model_name)
-simcse_model = AutoModel.from_pretrained(simcse_model_name)
+simcse_model = load_model(AutoModel, simcse_model_name)
 mt5_tokenizer = AutoTokenizer.from_pretrained(mt5_model_name)
-mt5_model = MT5ForConditionalGeneration.from_pretrained(mt5_model_name)
+mt5_model = load_model(MT5ForConditionalGeneration, mt5_model_name)
 
 # Load dataset and select 10 samples
 # dataset = load_dataset('wanhin/msimcse_512_seqlen', split='train[:10]')
 dataset = load_dataset('wanhin/msimcse_512_seqlen')['train']
-src_texts = dataset['sent0']
-tgt_texts = dataset['sent1']
-
-# Prepare the inputs for each sample
-simcse_inputs = [simcse_tokenizer(text, return_tensors='pt', padding=True, truncation=True, max_length=512) for text in src_texts]
-mt5_inputs = [mt5_tokenizer(text, return_tensors='pt', padding=True, truncation=True, max_length=512) for text in src_texts]
-mt5_targets = [mt5_tokenizer(f"translate Vietnamese to English: {text}", return_tensors='pt', padding=True, truncation=True, max_length=512) for text in tgt_texts]
+max_length = 512
+seed = 42
+dataset_num_workers = 8  # Upper bound on tokenization worker processes
+# CPUs this process may actually run on (respects affinity masks, unlike os.cpu_count())
+available_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+# This script has no __main__ guard, so worker processes are only safe when they are forked;
+# spawned workers (the default on macOS and Windows) would re-run the whole script
+fork_available = multiprocessing.get_start_method() == "fork"
+
+# Tokenize a whole batch of samples per call so the fast tokenizers can work on it in parallel.
+# Tokenizers are passed in through fn_kwargs rather than read from globals, so the map workers
+# receive them explicitly instead of through pickled __main__ globals.
+def tokenize_fn(batch, simcse_tokenizer, mt5_tokenizer, max_length):
+    simcse_inputs = simcse_tokenizer(batch['sent0'], truncation=True, max_length=max_length)
+    mt5_inputs = mt5_tokenizer(batch['sent0'], text_target=[f"translate Vietnamese to English: {text}" for text in batch['sent1']],
+                               truncation=True, max_length=max_length)
+    return {
+        "simcse_input_ids": simcse_inputs['input_ids'],
+        "mt5_input_ids": mt5_inputs['input_ids'],
+        "mt5_attention_mask": mt5_inputs['attention_mask'],
+        "mt5_target_ids": mt5_inputs['labels'],
+        "length": [len(ids) for ids in mt5_inputs['input_ids']],
+    }
+
+# Shuffle first so long and short samples are spread evenly over the map workers' contiguous shards
+# (shuffle only builds an indices mapping, it does not rewrite the Arrow data)
+dataset = dataset.shuffle(seed=seed)
+
+# Use at most one worker per 1000 samples so small datasets don't pay for process start-up and IPC
+num_proc = min(dataset_num_workers, available_cpus, max(1, len(dataset) // 1000)) if fork_available else 1
+if num_proc > 1:
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")  # Avoid Rust thread over-subscription inside the workers
+
+# Prepare the inputs for each sample, reusing the tokenized cache from a previous run when it exists.
+# The shuffled dataset's fingerprint ties the cache to the exact rows and order (split, seed, source data).
+cache_dir = os.path.dirname(dataset.cache_files[0]['filename'])
+cache_file_name = os.path.join(cache_dir, f"tokenized-{simcse_model_name.replace('/', '_')}-{mt5_model_name.replace('/', '_')}-{max_length}-{dataset._fingerprint}-{Hasher.hash(tokenize_fn)}.arrow")
+dataset = dataset.map(tokenize_fn, batched=True, batch_size=1000, remove_columns=dataset.column_names,
+                      fn_kwargs={"simcse_tokenizer": simcse_tokenizer, "mt5_tokenizer": mt5_tokenizer, "max_length": max_length},
+                      num_proc=num_proc, load_from_cache_file=True, cache_file_name=cache_file_name)
+lengths = list(dataset['length'])  # Read as plain ints before the torch format is applied
+dataset.set_format('torch')
+
+# Pad each batch only up to its own longest sample, rounded up to a multiple of 8 for tensor cores
+def pad_batch(sequences, padding_value, pad_to_multiple_of=8):
+    padded = torch.nn.utils.rnn.pad_sequence(sequences, batch_first=True, padding_value=padding_value)
+    remainder = padded.size(1) % pad_to_multiple_of
+    if remainder:
+        padded = torch.nn.functional.pad(padded, (0, pad_to_multiple_of - remainder), value=padding_value)
+    return padded
+
+def collate_fn(samples):
+    simcse_input_ids = [sample['simcse_input_ids'] for sample in samples]
+    return {
+        "simcse_input_ids": pad_batch(simcse_input_ids, simcse_tokenizer.pad_token_id),
+        "simcse_attention_mask": pad_batch([torch.ones_like(ids) for ids in simcse_input_ids], 0),
+        "mt5_input_ids": pad_batch([sample['mt5_input_ids'] for sample in samples], mt5_tokenizer.pad_token_id),
+        "mt5_attention_mask": pad_batch([sample['mt5_attention_mask'] for sample in samples], 0),
+        "mt5_target_ids": pad_batch([sample['mt5_target_ids'] for sample in samples], -100),  # -100 is ignored by the loss
+    }
 
 # Instantiate the embed-fusion module
 input_dim = 768
@@ -60,49 +132,83 @@ embed_fusion = EmbedFusion(input_dim, output_dim)
 
 # Define training parameters
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# Native bf16 needs Ampere or newer; is_bf16_supported() also reports emulated bf16 on older GPUs
+use_bf16 = torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8
+torch.backends.cuda.matmul.allow_tf32 = True  # Use TF32 tensor cores for any matmul left in fp32
+torch.backends.cudnn.allow_tf32 = True
 embed_fusion.to(device)
-mt5_model.to(device)
+mt5_model.to(device).train()  # Set mT5 model to training mode (from_pretrained returns it in eval mode)
 simcse_model.to(device).eval()  # Set SimCSE model to evaluation mode
 
+# Recompute mT5 activations in the backward pass instead of storing them, trading some compute for
+# much lower activation memory so a larger batch_size fits on the GPU
+gradient_checkpointing = False
+if gradient_checkpointing:
+    mt5_model.gradient_checkpointing_enable()
+    mt5_model.config.use_cache = False
+
 optimizer = torch.optim.Adam(list(embed_fusion.parameters()) + list(mt5_model.parameters()), lr=1e-4)
-loss_fn = torch.nn.CrossEntropyLoss(ignore_index=mt5_tokenizer.pad_token_id)
 
 # Log model parameters and gradients
 wandb.watch(embed_fusion, log="all")
 wandb.watch(mt5_model, log="all")
 
+# Compile the trainable modules in place (keeps parameter names and state_dict keys unchanged).
+# Batch shapes vary with dynamic padding, so compile for dynamic shapes rather than using CUDA graphs.
+# mT5 is compiled per stack so the standalone get_encoder() pass is compiled too, and only the
+# fusion module's forward is compiled so the wandb.watch hooks on the top-level modules stay eager.
+if device.type == "cuda" and hasattr(torch.nn.Module, "compile"):
+    embed_fusion.forward = torch.compile(embed_fusion.forward, dynamic=True)
+    mt5_model.encoder.compile(dynamic=True)
+    mt5_model.decoder.compile(dynamic=True)
+
 # Training loop
 num_epochs = 50  # Set the number of epochs
+batch_size = 8
+
+# Batch samples of similar length together so little of each batch is padding
+train_sampler = LengthGroupedSampler(batch_size, lengths=lengths)
+# Collate the next batches in background workers kept alive across epochs, into pinned memory for fast copies to the GPU
+dataloader_num_workers = 8  # Upper bound on DataLoader worker processes
+num_workers = min(dataloader_num_workers, available_cpus) if fork_available else 0
+if num_workers > 0:
+    # The workers never tokenize; this only stops the tokenizers warning in every forked worker
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+train_dataloader = DataLoader(dataset, batch_size=batch_size, sampler=train_sampler, collate_fn=collate_fn,
+                              num_workers=num_workers, persistent_workers=num_workers > 0,
+                              prefetch_factor=4 if num_workers > 0 else None,
+                              pin_memory=device.type == "cuda")
 
 for epoch in range(num_epochs):
     epoch_loss = 0
-    for i in range(len(src_texts)):
-        simcse_input = simcse_inputs[i]
-        mt5_input = mt5_inputs[i]
-        mt5_target = mt5_targets[i]
-
-        simcse_input_ids = simcse_input['input_ids'].squeeze(1).to(device)
-        mt5_input_ids = mt5_input['input_ids'].squeeze(1).to(device)
-        mt5_target_ids = mt5_target['input_ids'].squeeze(1).to(device)
-
-        # Get sentence embedding from SimCSE
-        with torch.no_grad():
-            simcse_outputs = simcse_model(simcse_input_ids)
-            sentence_embedding = simcse_outputs.last_hidden_state.mean(dim=1)  # Average pooling
-
-        # Get word embeddings from mT5 encoder
-        encoder_outputs = mt5_model.get_encoder()(input_ids=mt5_input_ids)
-        word_embeddings = encoder_outputs.last_hidden_state
-
-        # Combine embeddings using embed-fusion module
-        fused_embeddings = embed_fusion(sentence_embedding, word_embeddings)
+    for i, batch in enumerate(train_dataloader):
+        simcse_input_ids = batch['simcse_input_ids'].to(device, non_blocking=True)
+        simcse_attention_mask = batch['simcse_attention_mask'].to(device, non_blocking=True)
+        mt5_input_ids = batch['mt5_input_ids'].to(device, non_blocking=True)
+        mt5_target_ids = batch['mt5_target_ids'].to(device, non_blocking=True)
 
         # Prepare attention mask
-        attention_mask = mt5_input['attention_mask'].squeeze(1).to(device)
-
-        # Forward pass through mT5 model
-        outputs = mt5_model(inputs_embeds=fused_embeddings, attention_mask=attention_mask, labels=mt5_target_ids)
-        loss = outputs.loss
+        attention_mask = batch['mt5_attention_mask'].to(device, non_blocking=True)
+
+        # Run the forward passes in bf16 where the GPU supports it; weights and optimizer state stay fp32
+        with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_bf16):
+            # Get sentence embedding from SimCSE
+            with torch.no_grad():
+                simcse_outputs = simcse_model(simcse_input_ids, attention_mask=simcse_attention_mask)
+                hidden_states = simcse_outputs.last_hidden_state.float()
+                mask = simcse_attention_mask.unsqueeze(-1).to(hidden_states.dtype)
+                sentence_embedding = (hidden_states * mask).sum(dim=1) / mask.sum(dim=1)  # Average pooling over real tokens
+
+            # Get word embeddings from mT5 encoder
+            encoder_outputs = mt5_model.get_encoder()(input_ids=mt5_input_ids, attention_mask=attention_mask)
+            word_embeddings = encoder_outputs.last_hidden_state
+
+            # Combine embeddings using embed-fusion module
+            fused_embeddings = embed_fusion(sentence_embedding, word_embeddings)
+
+            # Forward pass through mT5 model
+            outputs = mt5_model(inputs_embeds=fused_embeddings, attention_mask=attention_mask, labels=mt5_target_ids)
+            loss = outputs.loss
         epoch_loss += loss.item()
 
         # Backward pass and optimization
@@ -118,8 +224,15 @@ for epoch in range(num_epochs):
             "step": i + 1
         })
 
-    print(f"Epoch {epoch + 1}, Loss: {epoch_loss / len(src_texts)}")
-    wandb.log({"epoch_loss": epoch_loss / len(src_texts), "epoch": epoch + 1})
+    print(f"Epoch {epoch + 1}, Loss: {epoch_loss / len(train_dataloader)}")
+    wandb.log({"epoch_loss": epoch_loss / len(train_dataloader), "epoch": epoch + 1})
+
+# Save the trained mT5 model, its tokenizer and the embed-fusion weights as safetensors
+output_dir = "checkpoint"
+mt5_model.config.use_cache = True  # Gradient checkpointing turns the cache off; keep it on for generation
+mt5_model.save_pretrained(output_dir, safe_serialization=True)
+mt5_tokenizer.save_pretrained(output_dir)
+save_file(embed_fusion.state_dict(), os.path.join(output_dir, "embed_fusion.safetensors"))
 
 # End WandB run
 wandb.finish()
\ No newline at end of file